@@ -1,7 +1,7 @@
 
 
 import can,struct
-import motorsParams, utils
+import motorsParams, utils, safetyLimits
 import time, sys
 import math, os
 import numpy as np
@@ -13,6 +13,7 @@ maxRawKp = 2 ** 12 - 1  # 12-Bits for Raw Kp Values
 maxRawKd = 2 ** 12 - 1  # 12-Bits for Raw Kd Values
 maxRawCurrent = 2 ** 12 - 1  # 12-Bits for Raw Current Values
 dt_sleep = 0.0001  # Time before motor sends a reply
+cmd_tail_cache_size = 256  # Max. cached (velocity, kp, kd, torque) command tails per motor
 
 class CanMotorController():
     """
@@ -25,6 +26,8 @@ class CanMotorController():
 
     can_socket_declared = False
     motor_socket = None
+    # Optional canTrace.TraceRecorder logging every frame sent and received by any instance.
+    trace_recorder = None
 
     def __init__(self, can_socket='can0', motor_id=0x01, motor_type='AK80_6_V1p1', socket_timeout=0.05):
         """
@@ -46,6 +49,8 @@ class CanMotorController():
             self.motorParams = motorsParams.AK80_9_V2_PARAMS
         elif motor_type == 'AK80_64_V2':
             self.motorParams = motorsParams.AK80_64_V2_PARAMS
+        # Own copy, so change_motor_constants only affects this controller.
+        self.motorParams = dict(self.motorParams)
         print(self.motorParams)
         # can_socket = (can_socket,)
         self.motor_id = motor_id
@@ -64,17 +69,25 @@ class CanMotorController():
         elif CanMotorController.can_socket_declared:
             print("CAN Socket Already Available. Using: ", CanMotorController.motor_socket)
 
-        # Initialize the command BitArrays for performance optimization
-        self._p_des_BitArray = BitArray(uint=utils.float_to_uint(0, self.motorParams['P_MIN'],
-                                                           self.motorParams['P_MAX'], 16), length=16)
-        self._v_des_BitArray = BitArray(uint=utils.float_to_uint(0, self.motorParams['V_MIN'],
-                                                           self.motorParams['V_MAX'], 12), length=12)
-        self._kp_BitArray = BitArray(uint=0, length=12)
-        self._kd_BitArray = BitArray(uint=0, length=12)
-        self._tau_BitArray = BitArray(uint=0, length=12)
-        self._cmd_bytes = BitArray(uint=0, length=64)
         self._recv_bytes = BitArray(uint=0, length=48)
 
+        # Command caches, see _send_raw_command and send_rad_command.
+        self._clear_command_cache()
+        self.hold_enabled = False
+        self.hold_period = 0.01
+        self._last_send_time = 0.0
+
+        # Single-motor limiter by default. Use safetyLimits.SafetyLimiter.attach(controllers) to
+        # share one vectorized limiter (slew state and clip counters) across several motors.
+        self.limiter = safetyLimits.SafetyLimiter([self.motorParams])
+        self.limiter_index = 0
+
+        # Optional state estimator fed with every reply, see stateEstimator.StateEstimator.attach.
+        self.estimator = None
+        self.estimator_index = 0
+        # Receive time of the last reply, time.perf_counter clock.
+        self._reply_stamp = 0.0
+
     def _send_can_frame(self, data):
         """
         Send raw CAN data frame (in bytes) to the motor.
@@ -86,6 +99,10 @@ class CanMotorController():
         try:
             # CanMotorController.motor_socket.send(can_msg)
             CanMotorController.motor_socket.send(msg)
+            if CanMotorController.trace_recorder is not None:
+                msg.timestamp = time.time()
+                msg.is_rx = False
+                CanMotorController.trace_recorder(msg)
             print(msg)
         except Exception as e:
             print("Unable to Send CAN Frame.")
@@ -100,6 +117,13 @@ class CanMotorController():
             if message == None:
                 print("No message received, pass..")
                 return '0' '0' '0'
+            # Prefer the bus receive timestamp (epoch, set by the driver) over reading the clock
+            # here, so host-side delays before this point do not shift the estimator stamp.
+            now = time.perf_counter()
+            age = time.time() - message.timestamp
+            self._reply_stamp = now - age if 0.0 <= age < timeout else now
+            if CanMotorController.trace_recorder is not None:
+                CanMotorController.trace_recorder(message)
             print(message)
             return message.arbitration_id, message.dlc, message.data
             # frame, addr = CanMotorController.motor_socket.recvfrom(14)
@@ -114,11 +138,19 @@ class CanMotorController():
         Sends the enable motor command to the motor.
         """
         try:
+            # A cached frame (and hold mode re-sending it) is stale after enable/disable/zero.
+            self._clear_command_cache()
+            self.hold_enabled = False
+            self.limiter.reset(self.limiter_index)
+            if self.estimator is not None:
+                self.estimator.reset(self.estimator_index)
             self._send_can_frame(b'\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFC')
             utils.waitOhneSleep(dt_sleep)
             can_id, can_dlc, motorStatusData = self._recv_can_frame()
             rawMotorData = self.decode_motor_status(motorStatusData)
             pos, vel, curr = self.convert_raw_to_physical_rad(rawMotorData[0], rawMotorData[1],  rawMotorData[2])
+            # Slew limit the next command from where the motor actually is.
+            self.limiter.seed(self.limiter_index, pos)
             # print("Motor Enabled.")
             return pos, vel, curr
         except Exception as e:
@@ -130,6 +162,10 @@ class CanMotorController():
         Sends the disable motor command to the motor.
         """
         try:
+            self._clear_command_cache()
+            self.hold_enabled = False
+            if self.estimator is not None:
+                self.estimator.reset(self.estimator_index)
             self._send_can_frame(b'\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFD')
             utils.waitOhneSleep(dt_sleep)
             can_id, can_dlc, motorStatusData = self._recv_can_frame()
@@ -146,6 +182,11 @@ class CanMotorController():
         Sends command to set current position as Zero position.
         """
         try:
+            self._clear_command_cache()
+            self.hold_enabled = False
+            self.limiter.reset(self.limiter_index)
+            if self.estimator is not None:
+                self.estimator.reset(self.estimator_index)
             self._send_can_frame(b'\x7f\xff\x7f\xf0\x00\x00\x07\xff')
             utils.waitOhneSleep(dt_sleep)
 
@@ -156,6 +197,7 @@ class CanMotorController():
             rawMotorData = self.decode_motor_status(motorStatusData)
             pos, vel, curr = self.convert_raw_to_physical_rad(rawMotorData[0], rawMotorData[1],
                                                               rawMotorData[2])
+            self.limiter.seed(self.limiter_index, pos)
             print("Zero Position set.")
             return pos, vel, curr
         except Exception as e:
@@ -269,25 +311,28 @@ class CanMotorController():
         Sends data over CAN, reads response, and returns the motor status data (in bytes).
         """
 
-        self._p_des_BitArray.uint = p_des
-        self._v_des_BitArray.uint = v_des
-        self._kp_BitArray.uint = kp
-        self._kd_BitArray.uint = kd
-        self._tau_BitArray.uint = tau_ff
-        print("pos raw des after.bun: {}".format(self._p_des_BitArray.bin))
-
-        # cmd_BitArray = self._p_des_BitArray.bin[:8] + self._p_des_BitArray.bin[8:16]  \
-        #                + self._v_des_BitArray.bin[:4] + self._v_des_BitArray.bin[4:11] \
-        #                + self._kp_BitArray.bin[8:11]  + self._kp_BitArray.bin[:8] \
-        #                + self._kd_BitArray.bin[4:11] + self._kd_BitArray.bin[:4] \
-        #                + self._tau_BitArray.bin[:8] + self._tau_BitArray.bin[8:11]
-        cmd_BitArray = self._p_des_BitArray.bin + self._v_des_BitArray.bin + self._kp_BitArray.bin \
-                       + self._kd_BitArray.bin + self._tau_BitArray.bin
-
-        self._cmd_bytes.bin = cmd_BitArray
+        raw = (p_des, v_des, kp, kd, tau_ff)
+        if raw != self._last_raw_cmd:
+            if not 0 <= p_des <= motorsParams.maxRawPosition:
+                raise ValueError('Raw position out of range: {}'.format(p_des))
+            # Only the position (first two bytes) changes between most commands, the
+            # velocity/kp/kd/tau bytes are spliced in from the cache.
+            tail_key = raw[1:]
+            tail = self._cmd_tail_cache.get(tail_key)
+            if tail is None:
+                if not (0 <= v_des <= motorsParams.maxRawVelocity and 0 <= kp <= maxRawKp
+                        and 0 <= kd <= maxRawKd and 0 <= tau_ff <= maxRawTorque):
+                    raise ValueError('Raw command out of range: {}'.format(raw))
+                if len(self._cmd_tail_cache) >= cmd_tail_cache_size:
+                    self._cmd_tail_cache.clear()
+                tail = ((v_des << 36) | (kp << 24) | (kd << 12) | tau_ff).to_bytes(6, 'big')
+                self._cmd_tail_cache[tail_key] = tail
+            self._last_cmd_frame = p_des.to_bytes(2, 'big') + tail
+            self._last_raw_cmd = raw
 
         try:
-            self._send_can_frame(self._cmd_bytes.tobytes())
+            self._send_can_frame(self._last_cmd_frame)
+            self._last_send_time = time.perf_counter()
             utils.waitOhneSleep(dt_sleep)
             can_id, can_dlc, data = self._recv_can_frame()
             return can_id, can_dlc, data
@@ -297,7 +342,6 @@ class CanMotorController():
 
     def send_deg_command(self, p_des_deg, v_des_deg, kp, kd, tau_ff):
         """
-        TODO: Add assert statements to validate input ranges.
         Function to send data to motor in physical units:
         send_deg_command(position (deg), velocity (deg/s), kp, kd, Feedforward Torque (Nm))
         Sends data over CAN, reads response, and prints the current status in deg, deg/s, amps.
@@ -311,38 +355,90 @@ class CanMotorController():
         vel = math.degrees(vel_rad)
         return pos, vel, curr
 
-    def send_rad_command(self, p_des_rad, v_des_rad, kp, kd, tau_ff):
+    def send_rad_command(self, p_des_rad, v_des_rad, kp, kd, tau_ff, limit=True):
         """
-        TODO: Add assert statements to validate input ranges.
         Function to send data to motor in physical units:
         send_rad_command(position (rad), velocity (rad/s), kp, kd, Feedforward Torque (Nm))
+        Commands are passed through self.limiter first, unless limit is False (e.g. when they
+        were already limited for all motors with SafetyLimiter.apply).
         Sends data over CAN, reads response, and prints the current status in rad, rad/s, amps.
         """
-        # Check for Torque Limits
-        if (tau_ff < self.motorParams['T_MIN']):
-            print('Torque Commanded lower than the limit. Clipping Torque...')
-            print('Commanded Torque: {}'.format(tau_ff))
-            print('Torque Limit: {}'.format(self.motorParams['T_MIN']))
-            tau_ff = self.motorParams['T_MIN']
-        elif (tau_ff > self.motorParams['T_MAX']):
-            print('Torque Commanded higher than the limit. Clipping Torque...')
-            print('Commanded Torque: {}'.format(tau_ff))
-            print('Torque Limit: {}'.format(self.motorParams['T_MAX']))
-            tau_ff = self.motorParams['T_MAX']
-
-        rawPos, rawVel, rawKp, rawKd, rawTauff = self.convert_physical_rad_to_raw(p_des_rad, v_des_rad, kp, kd, tau_ff)
+        # Clamp p/v/kp/kd/tau to the motor profile and apply slew limits. Clip events are counted
+        # in self.limiter.clip_counts.
+        if limit:
+            p_des_rad, v_des_rad, kp, kd, tau_ff = self.limiter.apply_one(self.limiter_index, p_des_rad,
+                                                                          v_des_rad, kp, kd, tau_ff)
+
+        physical = (p_des_rad, v_des_rad, kp, kd, tau_ff)
+        if physical != self._last_physical_cmd:
+            self._last_raw_from_physical = self.convert_physical_rad_to_raw(p_des_rad, v_des_rad, kp, kd, tau_ff)
+            self._last_physical_cmd = physical
+        rawPos, rawVel, rawKp, rawKd, rawTauff = self._last_raw_from_physical
         # print("raw in: " + str(rawPos))
         can_id, can_dlc, motorStatusData = self._send_raw_command(rawPos, rawVel, rawKp, rawKd, rawTauff)
         rawMotorData = self.decode_motor_status(motorStatusData)
         pos, vel, curr = self.convert_raw_to_physical_rad(rawMotorData[0], rawMotorData[1],
                                                           rawMotorData[2])
+        if self.estimator is not None:
+            self._update_estimator(pos, vel, physical)
 
         return pos, vel, curr
 
+    def _update_estimator(self, pos, vel, physical):
+        self.estimator.update_one(self.estimator_index, pos, vel, self._reply_stamp)
+        if physical is None:
+            return  # frame not built from a physical command, keep the previous torque
+        # Torque the motor's own PD loop is expected to apply until the next reply.
+        p_des_rad, v_des_rad, kp, kd, tau_ff = physical
+        tau_expected = kp * (p_des_rad - pos) + kd * (v_des_rad - vel) + tau_ff
+        tau_expected = min(max(tau_expected, self.motorParams['T_MIN']), self.motorParams['T_MAX'])
+        self.estimator.set_torque(self.estimator_index, tau_expected)
+
+    def set_hold_mode(self, enabled, keepalive_rate=100.0):
+        """
+        In hold mode hold_tick() re-sends the last command frame at keepalive_rate (Hz), without
+        any conversion or packing, so a static joint keeps being commanded.
+        """
+        self.hold_enabled = enabled
+        self.hold_period = 1.0 / keepalive_rate
+
+    def hold_tick(self):
+        """
+        Call from the control loop while in hold mode. Re-sends the cached command frame if the
+        keep-alive period elapsed since the last send and returns the reply as
+        (position (rad), velocity (rad/s), current), otherwise returns None.
+        """
+        if not self.hold_enabled or self._last_cmd_frame is None:
+            return None
+        if time.perf_counter() - self._last_send_time < self.hold_period:
+            return None
+        can_id, can_dlc, motorStatusData = self._send_raw_command(*self._last_raw_cmd)
+        rawMotorData = self.decode_motor_status(motorStatusData)
+        pos, vel, curr = self.convert_raw_to_physical_rad(rawMotorData[0], rawMotorData[1], rawMotorData[2])
+        if self.estimator is not None:
+            physical = self._last_physical_cmd if self._last_raw_from_physical == self._last_raw_cmd else None
+            self._update_estimator(pos, vel, physical)
+        return pos, vel, curr
+
+    def _clear_command_cache(self):
+        self._last_physical_cmd = None
+        self._last_raw_from_physical = None
+        self._last_raw_cmd = None
+        self._last_cmd_frame = None
+        self._cmd_tail_cache = {}
+
+    def estimated_state(self, t=None):
+        """
+        Returns the estimated (position (rad), velocity (rad/s)) of this motor extrapolated to
+        time t (time.perf_counter clock, default now). Requires an attached estimator.
+        """
+        position, velocity = self.estimator.predict(t)
+        return position[self.estimator_index], velocity[self.estimator_index]
+
     def change_motor_constants(self, P_MIN_NEW, P_MAX_NEW, V_MIN_NEW, V_MAX_NEW, KP_MIN_NEW,
                                KP_MAX_NEW, KD_MIN_NEW, KD_MAX_NEW, T_MIN_NEW, T_MAX_NEW):
         """
-        Function to change the global motor constants. Default values are for AK80-6 motor from
+        Function to change the motor constants of this controller. Default values are for AK80-6 motor from
         CubeMars. For a differnt motor, the min/max values can be changed here for correct
         conversion.
         change_motor_params(P_MIN_NEW (radians), P_MAX_NEW (radians), V_MIN_NEW (rad/s),
@@ -359,3 +455,18 @@ class CanMotorController():
         self.motorParams['KD_MAX'] = KD_MAX_NEW
         self.motorParams['T_MIN'] = T_MIN_NEW
         self.motorParams['T_MAX'] = T_MAX_NEW
+        # Update the bounds in place, the limiter may be shared with other controllers.
+        self.limiter.set_bounds(self.limiter_index, self.motorParams)
+        self._clear_command_cache()
+
+
+def send_rad_commands(controllers, limiter, p_des_rad, v_des_rad, kp, kd, tau_ff):
+    """
+    Limit the commands of a group of motors in one vectorized pass and send them.
+    limiter is the SafetyLimiter returned by SafetyLimiter.attach(controllers), the command
+    arguments are array-likes with one entry per controller.
+    Returns a list of (position, velocity, current) replies.
+    """
+    cmd = limiter.apply(p_des_rad, v_des_rad, kp, kd, tau_ff).T.tolist()
+    return [controller.send_rad_command(p, v, kp_i, kd_i, tau, limit=False)
+            for controller, (p, v, kp_i, kd_i, tau) in zip(controllers, cmd)]
@@ -0,0 +1,264 @@
+import argparse, os, time
+import can
+import numpy as np
+import motorsParams, utils
+
+# Motor replies are 6 bytes (motor id, 16 bit position, 12 bit velocity, 12 bit current),
+# commands are 8 bytes. See CanMotorController.decode_motor_status.
+reply_dlc = 6
+
+
+class TraceRecorder():
+    """
+    Records raw bus traffic to a python-can log file. The format follows the file extension:
+    .asc (Vector ASC), .blf (Vector BLF), .log (candump), .csv, ...
+
+    Either attach it to the controllers (every frame sent or received by any
+    CanMotorController is written) or pass it to a can.Notifier as a listener of a sidecar bus.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._writer = can.Logger(filename)
+
+    def attach(self, controller_class):
+        """
+        Log all traffic of controller_class (normally canMotorController.CanMotorController).
+        """
+        controller_class.trace_recorder = self
+        self._controller_class = controller_class
+        return self
+
+    def on_message_received(self, msg):
+        self._writer.on_message_received(msg)
+
+    __call__ = on_message_received
+
+    def stop(self):
+        controller_class = getattr(self, '_controller_class', None)
+        if controller_class is not None and controller_class.trace_recorder is self:
+            controller_class.trace_recorder = None
+        self._writer.stop()
+
+
+def record(filename, channel='can0', interface='socketcan'):
+    """
+    Sidecar recorder: opens its own bus connection and logs all traffic until interrupted.
+    """
+    bus = can.interface.Bus(channel=channel, interface=interface)
+    recorder = TraceRecorder(filename)
+    notifier = can.Notifier(bus, [recorder])
+    print("Recording {} to {}. Ctrl+C to stop.".format(channel, filename))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        notifier.stop()
+        recorder.stop()
+        bus.shutdown()
+
+
+class ReplyDecoder():
+    """
+    Batched NumPy version of decode_motor_status + convert_raw_to_physical_rad.
+
+    motors: {motor_id: motor params dict (see motorsParams)}. Replies of other ids are dropped.
+    """
+
+    def __init__(self, motors):
+        table_len = 256
+        self.known = np.zeros(table_len, dtype=bool)
+        columns = ('P_MIN', 'P_MAX', 'V_MIN', 'V_MAX', 'T_MIN', 'T_MAX', 'AXIS_DIRECTION')
+        self.table = np.zeros((len(columns), table_len))
+        for motor_id, params in motors.items():
+            self.known[motor_id] = True
+            self.table[:, motor_id] = [params[key] for key in columns]
+
+    def decode(self, frames):
+        """
+        frames: (n, 6) uint8 array of reply payloads.
+        Returns motor id, position (rad), velocity (rad/s) and current arrays of the known motors
+        and the mask of frames that were kept.
+        """
+        motor_id = frames[:, 0]
+        keep = self.known[motor_id]
+        frames = frames[keep].astype(np.uint32)
+        motor_id = frames[:, 0]
+        raw_pos = (frames[:, 1] << 8) | frames[:, 2]
+        raw_vel = (frames[:, 3] << 4) | (frames[:, 4] >> 4)
+        raw_cur = ((frames[:, 4] & 0xF) << 8) | frames[:, 5]
+
+        p_min, p_max, v_min, v_max, t_min, t_max, direction = self.table[:, motor_id]
+        position = (raw_pos * (p_max - p_min) / motorsParams.maxRawPosition + p_min) * direction
+        velocity = (raw_vel * (v_max - v_min) / motorsParams.maxRawVelocity + v_min) * direction
+        current = (raw_cur * (t_max - t_min) / motorsParams.maxRawVelocity + t_min) * direction
+        return motor_id, position, velocity, current, keep
+
+
+def decode_reply(data, params):
+    """
+    Scalar reference decode of one reply payload, same math as
+    CanMotorController.decode_motor_status + convert_raw_to_physical_rad without the prints.
+    """
+    raw_pos = (data[1] << 8) | data[2]
+    raw_vel = (data[3] << 4) | (data[4] >> 4)
+    raw_cur = ((data[4] & 0xF) << 8) | data[5]
+    direction = params['AXIS_DIRECTION']
+    position = utils.uint_to_float(raw_pos, params['P_MIN'], params['P_MAX'], 16) * direction
+    velocity = utils.uint_to_float(raw_vel, params['V_MIN'], params['V_MAX'], 12) * direction
+    current = utils.uint_to_float(raw_cur, params['T_MIN'], params['T_MAX'], 12) * direction
+    return position, velocity, current
+
+
+def _read_batches(filename, batch_size):
+    """
+    Yields (time, payload) arrays of up to batch_size motor replies read from a log file.
+    The arrays are reused for the next batch.
+    """
+    stamps = np.empty(batch_size)
+    frames = np.empty((batch_size, reply_dlc), dtype=np.uint8)
+    n = 0
+    for msg in can.LogReader(filename):
+        if msg.dlc != reply_dlc or msg.is_error_frame or msg.is_remote_frame:
+            continue
+        stamps[n] = msg.timestamp
+        frames[n] = msg.data[:reply_dlc]
+        n += 1
+        if n == batch_size:
+            yield stamps, frames
+            n = 0
+    if n:
+        yield stamps[:n], frames[:n]
+
+
+def replay(filename, motors, batch_size=65536):
+    """
+    Stream a recorded session through the reply decoder. Memory use is bounded by batch_size,
+    so multi-gigabyte traces can be processed.
+
+    Yields one dict per batch: {motor_id: (time, position, velocity, current) arrays}.
+    """
+    decoder = ReplyDecoder(motors)
+    for stamps, frames in _read_batches(filename, batch_size):
+        yield _split_by_motor(decoder, stamps, frames)
+
+
+def replay_scalar(filename, motors):
+    """
+    Frame-by-frame version of replay() using decode_reply. Yields (time, motor_id, position,
+    velocity, current) per reply.
+    """
+    for msg in can.LogReader(filename):
+        if msg.dlc != reply_dlc or msg.is_error_frame or msg.is_remote_frame:
+            continue
+        params = motors.get(msg.data[0])
+        if params is None:
+            continue
+        yield (msg.timestamp, msg.data[0]) + decode_reply(msg.data, params)
+
+
+def _split_by_motor(decoder, stamps, frames):
+    motor_id, position, velocity, current, keep = decoder.decode(frames)
+    stamps = stamps[keep]
+    series = {}
+    for mid in np.unique(motor_id).tolist():
+        mask = motor_id == mid
+        series[mid] = (stamps[mask], position[mask], velocity[mask], current[mask])
+    return series
+
+
+def replay_to_csv(filename, motors, out_dir, batch_size=65536):
+    """
+    Write the per-motor time series of a recording to out_dir/motor_<id>.csv
+    (time, position (rad), velocity (rad/s), current). Returns the number of replies per motor.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    files = {}
+    counts = {}
+    try:
+        for series in replay(filename, motors, batch_size):
+            for mid, columns in series.items():
+                if mid not in files:
+                    files[mid] = open(os.path.join(out_dir, 'motor_{}.csv'.format(mid)), 'w')
+                    files[mid].write('time,position,velocity,current\n')
+                    counts[mid] = 0
+                np.savetxt(files[mid], np.column_stack(columns), delimiter=',',
+                           fmt=('%.6f', '%.9g', '%.9g', '%.9g'))
+                counts[mid] += len(columns[0])
+    finally:
+        for f in files.values():
+            f.close()
+    return counts
+
+
+def benchmark(filename, motors, batch_size=65536):
+    """
+    Decode throughput on a real recording, batched NumPy vs frame-by-frame. Reading and parsing
+    the log file is timed separately, it usually dominates.
+    """
+    decoder = ReplyDecoder(motors)
+    n_batched = 0
+    batchedTime = 0.0
+    startTime = time.perf_counter()
+    for stamps, frames in _read_batches(filename, batch_size):
+        decodeStart = time.perf_counter()
+        series = _split_by_motor(decoder, stamps, frames)
+        batchedTime += time.perf_counter() - decodeStart
+        n_batched += sum(len(columns[0]) for columns in series.values())
+    readTime = time.perf_counter() - startTime - batchedTime
+
+    n_scalar = 0
+    scalarTime = 0.0
+    for msg in can.LogReader(filename):
+        params = motors.get(msg.data[0]) if msg.dlc == reply_dlc else None
+        if params is None:
+            continue
+        decodeStart = time.perf_counter()
+        decode_reply(msg.data, params)
+        scalarTime += time.perf_counter() - decodeStart
+        n_scalar += 1
+
+    print("Reading: {} replies in {:.3f} s".format(n_batched, readTime))
+    print("Batched decode: {:.0f} replies/s".format(n_batched / max(batchedTime, 1e-9)))
+    print("Scalar decode:  {:.0f} replies/s".format(n_scalar / max(scalarTime, 1e-9)))
+
+
+def _parse_motors(specs):
+    """
+    Parse ['8:AK80_9_V2', '0x09:AK80_9_V2'] into {motor_id: motor params dict}.
+    """
+    motors = {}
+    for spec in specs:
+        motor_id, motor_type = spec.split(':')
+        assert motor_type in motorsParams.legitimate_motors, 'Motor Type not in list of accepted motors.'
+        motors[int(motor_id, 0)] = getattr(motorsParams, motor_type + '_PARAMS')
+    return motors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record and replay CAN traces of AK motors.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    rec = sub.add_parser('record', help='record bus traffic (.asc/.blf/.log) as a sidecar')
+    rec.add_argument('filename')
+    rec.add_argument('--channel', default='can0')
+    rec.add_argument('--interface', default='socketcan')
+    for name, help_text in (('replay', 'decode a recording to per-motor CSV files'),
+                            ('benchmark', 'measure decode throughput on a recording')):
+        cmd = sub.add_parser(name, help=help_text)
+        cmd.add_argument('filename')
+        cmd.add_argument('motors', nargs='+', help='motor_id:motor_type, e.g. 8:AK80_9_V2')
+        cmd.add_argument('--batch-size', type=int, default=65536)
+        if name == 'replay':
+            cmd.add_argument('--out', default='replay')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(args.filename, args.channel, args.interface)
+    elif args.command == 'replay':
+        counts = replay_to_csv(args.filename, _parse_motors(args.motors), args.out, args.batch_size)
+        for motor_id, count in sorted(counts.items()):
+            print("Motor {}: {} replies".format(motor_id, count))
+    else:
+        benchmark(args.filename, _parse_motors(args.motors), args.batch_size)
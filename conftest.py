@@ -0,0 +1,37 @@
+import time
+import can
+import pytest
+import canMotorController as mot_con
+
+
+class FakeBus():
+    """
+    Stands in for the SocketCAN bus: records sent payloads and answers every frame with the
+    reply payload in self.reply. If reply_age is set, replies carry a driver timestamp that
+    many seconds in the past, otherwise no timestamp (0).
+    """
+
+    def __init__(self):
+        self.sent = []
+        self.reply = b'\x01\x80\x00\x80\x08\x00'
+        self.reply_age = None
+
+    def send(self, msg):
+        self.sent.append(bytes(msg.data))
+
+    def recv(self, timeout=5):
+        timestamp = 0.0 if self.reply_age is None else time.time() - self.reply_age
+        return can.Message(timestamp=timestamp, arbitration_id=0, data=self.reply, is_extended_id=False)
+
+
+@pytest.fixture
+def fake_bus(monkeypatch):
+    """
+    Makes every CanMotorController use a FakeBus instead of opening can0.
+    """
+    bus = FakeBus()
+    monkeypatch.setattr(mot_con.CanMotorController, 'can_socket_declared', True)
+    monkeypatch.setattr(mot_con.CanMotorController, 'motor_socket', bus)
+    monkeypatch.setattr(mot_con.CanMotorController, 'trace_recorder', None)
+    monkeypatch.setattr(mot_con, 'dt_sleep', 0)
+    return bus
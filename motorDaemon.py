@@ -0,0 +1,354 @@
+import os, socket, select, time, sys
+import numpy as np
+from multiprocessing import shared_memory
+import canMotorController as mot_con
+import safetyLimits, utils
+
+# Shared memory layout (all fields 8 bytes, native byte order):
+#   header      : magic, layout version, number of motors, daemon tick counter
+#   cmd_seq[n]  : seqlock counters of the command slots (odd while being written)
+#   state_seq[n]: seqlock counters of the state slots
+#   cmd[n, 5]   : p_des (rad), v_des (rad/s), kp, kd, tau_ff (Nm)
+#   state[n, 4] : position (rad), velocity (rad/s), current, reply time (time.time())
+#
+# The seqlock is plain Python/NumPy loads and stores without memory barriers. It relies on the
+# stores being seen in program order, which x86 (TSO) guarantees. On weaker memory models
+# (e.g. aarch64) a reader can see an even counter next to a half-written slot.
+SHM_MAGIC = 0x414B4354524C  # 'AKCTRL'
+SHM_VERSION = 1
+HEADER_LEN = 4
+CMD_LEN = 5
+STATE_LEN = 4
+default_shm_name = 'ak_control'
+seq_read_retries = 100  # Attempts before a seqlock read gives up (writer died or stalled)
+
+
+def _shm_size(num_motors):
+    return 8 * (HEADER_LEN + 2 * num_motors + num_motors * (CMD_LEN + STATE_LEN))
+
+
+def _map_slots(buf, num_motors):
+    """
+    Returns numpy views (header, cmd_seq, state_seq, cmd, state) onto the shared buffer.
+    """
+    offset = 0
+    header = np.ndarray((HEADER_LEN,), dtype=np.uint64, buffer=buf, offset=offset)
+    offset += 8 * HEADER_LEN
+    cmd_seq = np.ndarray((num_motors,), dtype=np.uint64, buffer=buf, offset=offset)
+    offset += 8 * num_motors
+    state_seq = np.ndarray((num_motors,), dtype=np.uint64, buffer=buf, offset=offset)
+    offset += 8 * num_motors
+    cmd = np.ndarray((num_motors, CMD_LEN), dtype=np.float64, buffer=buf, offset=offset)
+    offset += 8 * num_motors * CMD_LEN
+    state = np.ndarray((num_motors, STATE_LEN), dtype=np.float64, buffer=buf, offset=offset)
+    return header, cmd_seq, state_seq, cmd, state
+
+
+def _seq_write(seq, slots, index, values):
+    """
+    Seqlock write of one slot. There must be a single writer per slot.
+    """
+    if seq[index] & 1:
+        # The previous writer of this slot died mid-write, make the counter even again.
+        seq[index] += 1
+    seq[index] += 1
+    slots[index] = values
+    seq[index] += 1
+
+
+def _seq_read(seq, slots, index):
+    """
+    Seqlock read of one slot. Retries up to seq_read_retries times until a consistent copy was
+    read. Returns (sequence number, values as list), or None if the slot stayed inconsistent,
+    e.g. because its writer was killed between the two counter increments.
+    """
+    for _ in range(seq_read_retries):
+        begin = int(seq[index])
+        if begin & 1:
+            continue
+        values = slots[index].tolist()
+        if int(seq[index]) == begin:
+            return begin, values
+    return None
+
+
+class MotorClient():
+    """
+    Client side of the motor daemon. Attaches to the daemon's shared memory block and reads
+    motor states / writes setpoints without any serialization.
+
+    Every motor's command slot must only be written by one client process at a time.
+    """
+
+    def __init__(self, name=default_shm_name):
+        try:
+            self._shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Python < 3.13 always registers with the resource tracker, which would unlink the
+            # daemon's block when this client exits.
+            self._shm = shared_memory.SharedMemory(name=name)
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(self._shm._name, 'shared_memory')
+        header = np.ndarray((HEADER_LEN,), dtype=np.uint64, buffer=self._shm.buf)
+        assert int(header[0]) == SHM_MAGIC and int(header[1]) == SHM_VERSION, \
+            'Shared memory block {} is not a motor daemon block.'.format(name)
+        self.num_motors = int(header[2])
+        self._header, self._cmd_seq, self._state_seq, self._cmd, self._state = \
+            _map_slots(self._shm.buf, self.num_motors)
+        self._last_states = [[float('nan')] * STATE_LEN for _ in range(self.num_motors)]
+        self.seq_read_failures = [0] * self.num_motors
+
+    def tick(self):
+        """
+        Returns the daemon's loop counter, can be used as a heartbeat.
+        """
+        return int(self._header[3])
+
+    def read_state(self, index):
+        """
+        Returns the latest (position (rad), velocity (rad/s), current, reply time) of a motor.
+        If the slot cannot be read consistently the previous state is returned and counted in
+        seq_read_failures.
+        """
+        read = _seq_read(self._state_seq, self._state, index)
+        if read is None:
+            self.seq_read_failures[index] += 1
+        else:
+            self._last_states[index] = read[1]
+        return self._last_states[index]
+
+    def read_states(self):
+        """
+        Returns a consistent (num_motors, 4) copy of all motor states.
+        """
+        return np.array([self.read_state(i) for i in range(self.num_motors)])
+
+    def write_command(self, index, p_des_rad, v_des_rad, kp, kd, tau_ff):
+        """
+        Sets the setpoint of a motor, sent by the daemon from its next tick on.
+        """
+        _seq_write(self._cmd_seq, self._cmd, index, (p_des_rad, v_des_rad, kp, kd, tau_ff))
+
+    def close(self):
+        del self._header, self._cmd_seq, self._state_seq, self._cmd, self._state
+        self._shm.close()
+
+
+class MotorDaemon():
+    """
+    Owns the CAN controllers of all motors and runs the fixed-rate bus loop. Setpoints and states
+    are exchanged with other processes (see MotorClient) through per-motor seqlocked slots in a
+    multiprocessing.shared_memory block.
+
+    motors: list of (can_socket, motor_id, motor_type) tuples, slot i is motors[i].
+    control_socket: optional Unix socket path accepting line commands:
+        enable <i>, disable <i>, zero <i>, status, stop
+    Motors are only commanded once enabled and after a client wrote a setpoint after enabling,
+    the first one is slew limited from the position measured on enable.
+    """
+
+    def __init__(self, motors, rate=500.0, name=default_shm_name, control_socket=None):
+        self.controllers = [mot_con.CanMotorController(can_socket, motor_id, motor_type)
+                            for can_socket, motor_id, motor_type in motors]
+        self.limiter = safetyLimits.SafetyLimiter.attach(self.controllers)
+        self.num_motors = len(self.controllers)
+        self.period = 1.0 / rate
+        self.enabled = [False] * self.num_motors
+        # Command sequence number at enable time and whether a newer setpoint arrived since.
+        self._enable_seq = [0] * self.num_motors
+        self._armed = [False] * self.num_motors
+        # Last consistent (sequence number, command) read of every slot.
+        self._last_reads = [(0, [0.0] * CMD_LEN) for _ in range(self.num_motors)]
+        self.seq_read_failures = [0] * self.num_motors
+        self.running = False
+
+        self._shm = shared_memory.SharedMemory(name=name, create=True, size=_shm_size(self.num_motors))
+        self._header, self._cmd_seq, self._state_seq, self._cmd, self._state = \
+            _map_slots(self._shm.buf, self.num_motors)
+        self._cmd_seq[:] = 0
+        self._state_seq[:] = 0
+        self._cmd[:] = 0
+        self._state[:] = np.nan
+        self._header[:] = (SHM_MAGIC, SHM_VERSION, self.num_motors, 0)
+
+        self._control = None
+        self._connections = []
+        if control_socket is not None:
+            if os.path.exists(control_socket):
+                os.unlink(control_socket)
+            self._control_path = control_socket
+            self._control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._control.bind(control_socket)
+            self._control.listen(4)
+            self._control.setblocking(False)
+
+    def _publish_state(self, index, reply):
+        if reply is None:
+            return
+        pos, vel, curr = reply
+        _seq_write(self._state_seq, self._state, index, (pos, vel, curr, time.time()))
+
+    def _read_command(self, index):
+        """
+        Bounded seqlock read of a command slot. A slot that cannot be read (e.g. its client died
+        mid-write) keeps its previous command and is counted in seq_read_failures, so one
+        crashed client can never stall the bus loop.
+        """
+        read = _seq_read(self._cmd_seq, self._cmd, index)
+        if read is None:
+            self.seq_read_failures[index] += 1
+        else:
+            self._last_reads[index] = read
+        return self._last_reads[index]
+
+    def enable(self, index):
+        """
+        Enables a motor. Setpoints written before this call are ignored, the motor is commanded
+        from the next setpoint on. Returns the reply or None if the motor did not answer.
+        """
+        reply = self.controllers[index].enable_motor()
+        self._publish_state(index, reply)
+        if reply is not None:
+            self._enable_seq[index] = self._read_command(index)[0]
+            self._armed[index] = False
+            self.enabled[index] = True
+        return reply
+
+    def disable(self, index):
+        self.enabled[index] = False
+        reply = self.controllers[index].disable_motor()
+        self._publish_state(index, reply)
+        return reply
+
+    def zero(self, index):
+        """
+        Sets the zero position. Like enable, the motor then waits for a fresh setpoint.
+        """
+        reply = self.controllers[index].set_zero_position()
+        self._publish_state(index, reply)
+        if reply is not None:
+            self._enable_seq[index] = self._read_command(index)[0]
+            self._armed[index] = False
+        return reply
+
+    def _handle_control_line(self, line):
+        words = line.split()
+        if not words:
+            return ''
+        try:
+            if words[0] == 'stop':
+                self.running = False
+            elif words[0] == 'status':
+                return ' '.join('1' if enabled else '0' for enabled in self.enabled)
+            elif words[0] in ('enable', 'disable', 'zero'):
+                index = int(words[1])
+                if not 0 <= index < self.num_motors:
+                    return 'error motor index out of range: {}'.format(index)
+                if getattr(self, words[0])(index) is None:
+                    return 'error no reply from motor'
+            else:
+                return 'error unknown command'
+        except (IndexError, ValueError) as e:
+            return 'error {}'.format(e)
+        return 'ok'
+
+    def _poll_control(self):
+        """
+        Non-blocking service of the Unix socket control channel.
+        """
+        readable, _, _ = select.select([self._control] + self._connections, [], [], 0)
+        for sock in readable:
+            if sock is self._control:
+                try:
+                    connection, _ = self._control.accept()
+                except OSError:
+                    continue
+                connection.setblocking(False)
+                self._connections.append(connection)
+                continue
+            # A misbehaving client (reset connection, not reading its replies) only loses its
+            # own connection, it must never stop the bus loop.
+            try:
+                data = sock.recv(1024)
+                if data:
+                    replies = [self._handle_control_line(line) for line in data.decode().splitlines()]
+                    sock.sendall(''.join(reply + '\n' for reply in replies).encode())
+                    continue
+            except (OSError, UnicodeDecodeError):
+                pass
+            self._connections.remove(sock)
+            sock.close()
+
+    def step(self):
+        """
+        One bus cycle: read all command slots, limit them in one pass and send them to every
+        enabled motor with a setpoint, then publish the replies.
+        """
+        reads = [self._read_command(i) for i in range(self.num_motors)]
+        now = time.perf_counter()
+        active = np.zeros(self.num_motors, dtype=bool)
+        for i, (seq, _) in enumerate(reads):
+            if not self.enabled[i] or seq == self._enable_seq[i]:
+                continue
+            if not self._armed[i]:
+                # First setpoint since enable/zero: allow one tick of slew from the measured
+                # position instead of whatever was commanded before.
+                self.limiter.seed(i, self._state[i, 0], now - self.period)
+                self._armed[i] = True
+            active[i] = True
+
+        if active.any():
+            commands = np.array([values for _, values in reads])
+            cmd = self.limiter.apply(commands[:, 0], commands[:, 1], commands[:, 2], commands[:, 3],
+                                     commands[:, 4], now=now, active=active).T.tolist()
+            for i in np.flatnonzero(active).tolist():
+                self._publish_state(i, self.controllers[i].send_rad_command(*cmd[i], limit=False))
+        self._header[3] += 1
+
+    def run(self):
+        """
+        Runs the fixed-rate bus loop until stopped over the control channel or interrupted.
+        """
+        self.running = True
+        next_tick = time.perf_counter()
+        try:
+            while self.running:
+                self.step()
+                if self._control is not None:
+                    self._poll_control()
+                next_tick += self.period
+                remaining = next_tick - time.perf_counter()
+                if remaining > 0:
+                    utils.waitOhneSleep(remaining)
+                else:
+                    # Overrun, do not try to catch up with a burst of frames.
+                    next_tick = time.perf_counter()
+        finally:
+            for i in range(self.num_motors):
+                if self.enabled[i]:
+                    self.disable(i)
+            self.close()
+
+    def close(self):
+        for connection in self._connections:
+            connection.close()
+        self._connections = []
+        if self._control is not None:
+            self._control.close()
+            self._control = None
+            os.unlink(self._control_path)
+        if self._shm is not None:
+            del self._header, self._cmd_seq, self._state_seq, self._cmd, self._state
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+
+if __name__ == '__main__':
+    # Usage: python motorDaemon.py <motor_type> <motor_id> [<motor_id> ...]
+    if len(sys.argv) < 3:
+        print('Provide the motor type and motor IDs, e.g. AK80_9_V2 8 9')
+        sys.exit(0)
+    daemon = MotorDaemon([('can0', int(motor_id, 0), sys.argv[1]) for motor_id in sys.argv[2:]],
+                         control_socket='/tmp/ak_control.sock')
+    daemon.run()
@@ -0,0 +1,220 @@
+import time, math
+import numpy as np
+
+# Row indices into SafetyLimiter.clip_counts
+CLIP_P = 0
+CLIP_V = 1
+CLIP_KP = 2
+CLIP_KD = 3
+CLIP_TAU = 4
+CLIP_P_SLEW = 5
+CLIP_TAU_SLEW = 6
+CLIP_NONFINITE = 7
+clip_names = ['p', 'v', 'kp', 'kd', 'tau', 'p_slew', 'tau_slew', 'nonfinite']
+
+
+class SafetyLimiter():
+    """
+    Command limiter for a group of motors. Clamps position, velocity, kp, kd and feed-forward
+    torque to the motor profile ranges and applies per-motor slew-rate limits to position and
+    torque, all as one NumPy pass over the command arrays of every motor.
+
+    Slew limits are read from the optional profile keys 'P_SLEW_MAX' (rad/s) and 'T_SLEW_MAX'
+    (Nm/s). Position slew defaults to V_MAX, torque slew defaults to unlimited. The time since the
+    previous command is capped at max_dt (s), so a command after a long pause cannot jump.
+
+    A command with any NaN/inf field is replaced by the motor's previous command (or by a
+    zero-gain, zero-torque command if there is none) and counted in the 'nonfinite' row.
+
+    Clip events are counted per field and motor in clip_counts (see CLIP_* rows), nothing is
+    printed.
+    """
+
+    def __init__(self, motor_params_list, max_dt=0.1):
+        n = len(motor_params_list)
+        self.num_motors = n
+        self.max_dt = max_dt
+
+        # Stacked bounds (rows p, v, kp, kd, tau) so the range clamp is a single np.clip over a
+        # (5, n) block. p_min, p_max, ... are row views.
+        self._lower = np.zeros((5, n), dtype=np.float64)
+        self._upper = np.zeros((5, n), dtype=np.float64)
+        self.p_min, self.v_min, self.kp_min, self.kd_min, self.t_min = self._lower
+        self.p_max, self.v_max, self.kp_max, self.kd_max, self.t_max = self._upper
+        self.p_slew = np.zeros(n, dtype=np.float64)
+        self.t_slew = np.zeros(n, dtype=np.float64)
+        for i, params in enumerate(motor_params_list):
+            self._set_bounds(i, params)
+        self._update_lists()
+
+        self._cmd = np.zeros((5, n), dtype=np.float64)
+        self._mask = np.zeros((5, n), dtype=bool)
+        self._mask_hi = np.zeros((5, n), dtype=bool)
+        self._step = np.zeros(n, dtype=np.float64)
+        self._delta = np.zeros(n, dtype=np.float64)
+        self._slew_mask = np.zeros(n, dtype=bool)
+        self._all = np.ones(n, dtype=bool)
+        self._last_cmd = np.zeros((5, n), dtype=np.float64)
+        self._last_p = self._last_cmd[0]
+        self._last_tau = self._last_cmd[4]
+        self._last_time = np.full(n, np.nan)
+
+        self.clip_counts = np.zeros((len(clip_names), n), dtype=np.int64)
+        self.reset()
+
+    @classmethod
+    def attach(cls, controllers):
+        """
+        Build one limiter for a list of CanMotorControllers and make every controller use it,
+        so single-motor commands and group commands share slew state and clip counters.
+        """
+        limiter = cls([controller.motorParams for controller in controllers])
+        for i, controller in enumerate(controllers):
+            controller.limiter = limiter
+            controller.limiter_index = i
+        return limiter
+
+    def _set_bounds(self, index, params):
+        self._lower[:, index] = [params[key] for key in ('P_MIN', 'V_MIN', 'KP_MIN', 'KD_MIN', 'T_MIN')]
+        self._upper[:, index] = [params[key] for key in ('P_MAX', 'V_MAX', 'KP_MAX', 'KD_MAX', 'T_MAX')]
+        self.p_slew[index] = params.get('P_SLEW_MAX', params['V_MAX'])
+        self.t_slew[index] = params.get('T_SLEW_MAX', np.inf)
+
+    def _update_lists(self):
+        # Plain python copies for the single motor path, numpy scalars are slow there.
+        self._lower_list = self._lower.T.tolist()
+        self._upper_list = self._upper.T.tolist()
+        self._p_slew_list = self.p_slew.tolist()
+        self._t_slew_list = self.t_slew.tolist()
+
+    def set_bounds(self, index, params):
+        """
+        Replace the limits of one motor with those of the motor params dict params, e.g. after
+        CanMotorController.change_motor_constants. Slew state and clip counters are kept.
+        """
+        self._set_bounds(index, params)
+        self._update_lists()
+
+    def reset(self, index=None):
+        """
+        Forget the previous command of one motor (or all motors if index is None) so its next
+        command is not slew limited, e.g. after enabling or zeroing.
+        """
+        if index is None:
+            index = slice(None)
+        self._last_cmd[:, index] = 0.0
+        self._last_time[index] = np.nan
+
+    def seed(self, index, position, now=None):
+        """
+        Start the slew limit of one motor from its measured position (e.g. the reply to enable),
+        as if a zero-gain command at that position had been sent at time now.
+        """
+        if now is None:
+            now = time.perf_counter()
+        self._last_cmd[:, index] = 0.0
+        self._last_p[index] = position
+        self._last_time[index] = now
+
+    def _slew(self, x, last, rate, dt, row, active):
+        np.multiply(rate, dt, out=self._step)
+        np.subtract(x, last, out=self._delta)
+        np.greater(np.abs(self._delta), self._step, out=self._slew_mask)
+        self._slew_mask &= active
+        self.clip_counts[row] += self._slew_mask
+        # Only clipped commands are rewritten (to last +/- step), others stay bit-identical.
+        np.copysign(self._step, self._delta, out=self._delta)
+        self._delta += last
+        np.copyto(x, self._delta, where=self._slew_mask)
+
+    def apply(self, p_des, v_des, kp, kd, tau_ff, now=None, active=None):
+        """
+        Limit the commands of all motors for one tick. Inputs are array-likes of length
+        num_motors in physical units (rad, rad/s, Nm). Returns a (5, num_motors) array with rows
+        p, v, kp, kd, tau. The returned array is reused on the next call.
+
+        active: optional bool mask of the motors that will actually be sent. Only their slew
+        state and clip counters are updated, the other columns of the result are meaningless.
+        """
+        if now is None:
+            now = time.perf_counter()
+        if active is None:
+            active = self._all
+        cmd = self._cmd
+        cmd[0] = p_des
+        cmd[1] = v_des
+        cmd[2] = kp
+        cmd[3] = kd
+        cmd[4] = tau_ff
+
+        # Hold the previous command of motors with a non-finite field. After reset() that is
+        # all zeros: zero gains and torque, the position is then irrelevant.
+        nonfinite = ~np.isfinite(cmd).all(axis=0)
+        if nonfinite.any():
+            self.clip_counts[CLIP_NONFINITE] += nonfinite & active
+            cmd[:, nonfinite] = self._last_cmd[:, nonfinite]
+
+        np.less(cmd, self._lower, out=self._mask)
+        np.greater(cmd, self._upper, out=self._mask_hi)
+        self._mask |= self._mask_hi
+        self._mask &= active
+        self.clip_counts[:5] += self._mask
+        np.clip(cmd, self._lower, self._upper, out=cmd)
+
+        # Motors without a previous command get an infinite dt, i.e. no slew limit.
+        dt = np.minimum(now - self._last_time, self.max_dt)
+        first = np.isnan(dt)
+        if not first.all():
+            dt[first] = np.inf
+            self._slew(cmd[0], self._last_p, self.p_slew, dt, CLIP_P_SLEW, active)
+            self._slew(cmd[4], self._last_tau, self.t_slew, dt, CLIP_TAU_SLEW, active)
+
+        np.copyto(self._last_cmd, cmd, where=active)
+        self._last_time[active] = now
+        return cmd
+
+    def apply_one(self, index, p_des, v_des, kp, kd, tau_ff, now=None):
+        """
+        Scalar version of apply() for a single motor of the group. Returns the limited
+        (p, v, kp, kd, tau) tuple.
+        """
+        if now is None:
+            now = time.perf_counter()
+        lower = self._lower_list[index]
+        upper = self._upper_list[index]
+        counts = self.clip_counts
+        cmd = [p_des, v_des, kp, kd, tau_ff]
+        if not all(map(math.isfinite, cmd)):
+            counts[CLIP_NONFINITE, index] += 1
+            cmd = self._last_cmd[:, index].tolist()
+        for row in range(5):
+            if cmd[row] < lower[row]:
+                cmd[row] = lower[row]
+                counts[row, index] += 1
+            elif cmd[row] > upper[row]:
+                cmd[row] = upper[row]
+                counts[row, index] += 1
+
+        last_time = self._last_time[index]
+        if last_time == last_time:  # not NaN
+            dt = min(now - last_time, self.max_dt)
+            for row, last, rate, clip_row in ((0, self._last_p[index], self._p_slew_list[index], CLIP_P_SLEW),
+                                              (4, self._last_tau[index], self._t_slew_list[index], CLIP_TAU_SLEW)):
+                # Same comparison and arithmetic as _slew so both paths count identically.
+                step = rate * dt
+                delta = cmd[row] - last
+                if abs(delta) > step:
+                    cmd[row] = last + (step if delta > 0 else -step)
+                    counts[clip_row, index] += 1
+
+        self._last_cmd[:, index] = cmd
+        self._last_time[index] = now
+        return cmd[0], cmd[1], cmd[2], cmd[3], cmd[4]
+
+    def clip_report(self):
+        """
+        Returns the clip counters as a list (one entry per motor) of {field: count} dicts.
+        Meant for logging outside the control loop.
+        """
+        return [dict(zip(clip_names, self.clip_counts[:, i].tolist()))
+                for i in range(self.num_motors)]
@@ -0,0 +1,195 @@
+import time
+import numpy as np
+import utils
+
+
+class StateEstimator():
+    """
+    Alpha-beta state estimator for a group of motors, vectorized across motors.
+
+    Replies from the motor are quantized and already stale when they are used. The estimator
+    filters the measured position/velocity of every reply and extrapolates the state to any
+    later time (e.g. "now" or the next send time) using the last commanded torque, so the outer
+    loop can run faster than the bus can poll every joint.
+
+    alpha, beta: position residual gains (position and velocity correction).
+    gamma: weight of the measured velocity in the velocity correction (0 ignores it).
+    inertia: per-motor output inertia (kg m^2) used to turn commanded torque into acceleration.
+             None disables the torque feed-forward.
+    latency: time (s) between the motor sampling its state and the reply timestamp. Controllers
+             stamp replies with the bus receive time (CAN driver timestamp mapped to the
+             time.perf_counter clock), so latency only covers the motor and bus transfer. With
+             interfaces that do not timestamp messages the stamp is taken after recv() returns
+             and latency must also absorb that host-side delay.
+    max_dt: longest extrapolation (s). predict() holds the state reached after max_dt, a reply
+            arriving more than max_dt after the previous one re-initializes the motor.
+    """
+
+    def __init__(self, num_motors, alpha=0.5, beta=0.05, gamma=0.7, inertia=None, latency=0.0,
+                 max_dt=0.05):
+        self.num_motors = num_motors
+        self.alpha = alpha
+        self.beta = beta
+        self.gamma = gamma
+        self.latency = latency
+        self.max_dt = max_dt
+        if inertia is None:
+            self.inv_inertia = np.zeros(num_motors)
+        else:
+            self.inv_inertia = 1.0 / np.broadcast_to(np.asarray(inertia, dtype=np.float64), (num_motors,))
+
+        self.position = np.zeros(num_motors)
+        self.velocity = np.zeros(num_motors)
+        self.torque = np.zeros(num_motors)
+        self.stamp = np.full(num_motors, np.nan)
+
+    @classmethod
+    def attach(cls, controllers, **kwargs):
+        """
+        Build one estimator for a list of CanMotorControllers. Every reply received by
+        send_rad_command then updates the estimator. Keyword arguments go to __init__.
+        """
+        estimator = cls(len(controllers), **kwargs)
+        for i, controller in enumerate(controllers):
+            controller.estimator = estimator
+            controller.estimator_index = i
+        return estimator
+
+    def reset(self, index=None):
+        """
+        Drop the state and torque of one motor (or all motors if index is None). The next reply
+        re-initializes it.
+        """
+        if index is None:
+            index = slice(None)
+        self.stamp[index] = np.nan
+        self.torque[index] = 0.0
+
+    def set_torque(self, index, tau_ff):
+        """
+        Store the commanded torque of motor(s) index, used for extrapolation until the next one.
+        """
+        self.torque[index] = tau_ff
+
+    def update(self, index, position, velocity, stamp):
+        """
+        Fuse replies of the motors selected by index (int, slice, index array or mask) measured at
+        reply time stamp (scalar or per motor, same clock as predict()).
+        """
+        t_meas = np.asarray(stamp, dtype=np.float64) - self.latency
+        p = self.position[index]
+        v = self.velocity[index]
+        dt = t_meas - self.stamp[index]
+        first = ~((dt > 0) & (dt <= self.max_dt))  # no (recent) previous state or out of order reply
+
+        acc = self.torque[index] * self.inv_inertia[index]
+        p_pred = p + v * dt + 0.5 * acc * dt * dt
+        v_pred = v + acc * dt
+        residual = position - p_pred
+        with np.errstate(divide='ignore', invalid='ignore'):
+            p_new = p_pred + self.alpha * residual
+            v_new = v_pred + self.beta * residual / dt + self.gamma * (velocity - v_pred)
+
+        self.position[index] = np.where(first, position, p_new)
+        self.velocity[index] = np.where(first, velocity, v_new)
+        self.stamp[index] = t_meas
+
+    def update_one(self, index, position, velocity, stamp):
+        """
+        Scalar version of update() for a single motor, avoids NumPy overhead per reply.
+        """
+        t_meas = stamp - self.latency
+        dt = t_meas - self.stamp[index]
+        if not 0 < dt <= self.max_dt:
+            self.position[index] = position
+            self.velocity[index] = velocity
+            self.stamp[index] = t_meas
+            return
+        acc = self.torque[index] * self.inv_inertia[index]
+        p_pred = self.position[index] + self.velocity[index] * dt + 0.5 * acc * dt * dt
+        v_pred = self.velocity[index] + acc * dt
+        residual = position - p_pred
+        self.position[index] = p_pred + self.alpha * residual
+        self.velocity[index] = v_pred + self.beta * residual / dt + self.gamma * (velocity - v_pred)
+        self.stamp[index] = t_meas
+
+    def predict(self, t=None):
+        """
+        Extrapolate all motors to time t (default: now, time.perf_counter clock).
+        Returns (position, velocity) arrays. Motors without a reply yet are returned as NaN.
+        """
+        if t is None:
+            t = time.perf_counter()
+        dt = np.minimum(t - self.stamp, self.max_dt)
+        acc = self.torque * self.inv_inertia
+        position = self.position + self.velocity * dt + 0.5 * acc * dt * dt
+        velocity = self.velocity + acc * dt
+        return position, velocity
+
+
+def simulate(motor_params, num_motors=4, duration=2.0, reply_period=0.004, control_period=0.001,
+             latency=0.0005, inertia=0.02, damping=0.05, seed=0):
+    """
+    Check the estimator against a simulated motor. Each motor follows a sine target under a PD
+    torque law, replies are quantized like decode_motor_status/convert_raw_to_physical_rad and
+    arrive reply_period apart with the given latency. Returns the RMS position and velocity
+    errors at control time of (a) the last raw reply and (b) the estimator prediction.
+    """
+    rng = np.random.default_rng(seed)
+    sim_dt = 1e-5
+    steps_per_control = int(round(control_period / sim_dt))
+    controls_per_reply = int(round(reply_period / control_period))
+    latency_steps = int(round(latency / sim_dt))
+
+    def quantize(x, x_min, x_max, num_bits):
+        raw = np.array([utils.float_to_uint(xi, x_min, x_max, num_bits) for xi in x])
+        return np.array([utils.uint_to_float(ri, x_min, x_max, num_bits) for ri in raw])
+
+    p = np.zeros(num_motors)
+    v = np.zeros(num_motors)
+    freq = rng.uniform(0.5, 2.0, num_motors)
+    amp = rng.uniform(0.3, 1.0, num_motors)
+    tau = np.zeros(num_motors)
+    history = []
+    estimator = StateEstimator(num_motors, inertia=inertia, latency=latency)
+    reply_p = np.zeros(num_motors)
+    reply_v = np.zeros(num_motors)
+    err_raw = []
+    err_est = []
+
+    n_control = int(duration / control_period)
+    t = 0.0
+    for k in range(n_control):
+        for _ in range(steps_per_control):
+            v += (tau - damping * v) / inertia * sim_dt
+            p += v * sim_dt
+            t += sim_dt
+            history.append((p.copy(), v.copy()))
+        if k % controls_per_reply == 0:
+            p_sampled, v_sampled = history[max(len(history) - 1 - latency_steps, 0)]
+            reply_p = quantize(p_sampled, motor_params['P_MIN'], motor_params['P_MAX'], 16)
+            reply_v = quantize(v_sampled, motor_params['V_MIN'], motor_params['V_MAX'], 12)
+            estimator.update(slice(None), reply_p, reply_v, t)
+        history = history[-latency_steps - 1:]
+
+        p_est, v_est = estimator.predict(t)
+        if k > controls_per_reply:
+            err_raw.append(np.concatenate((reply_p - p, reply_v - v)))
+            err_est.append(np.concatenate((p_est - p, v_est - v)))
+
+        target = amp * np.sin(2 * np.pi * freq * t)
+        tau = np.clip(20.0 * (target - p_est) - 1.0 * v_est, motor_params['T_MIN'], motor_params['T_MAX'])
+        estimator.set_torque(slice(None), tau)
+
+    err_raw = np.array(err_raw)
+    err_est = np.array(err_est)
+    rms = lambda e: np.sqrt(np.mean(e ** 2))
+    return {'raw_pos': rms(err_raw[:, :num_motors]), 'raw_vel': rms(err_raw[:, num_motors:]),
+            'est_pos': rms(err_est[:, :num_motors]), 'est_vel': rms(err_est[:, num_motors:])}
+
+
+if __name__ == '__main__':
+    import motorsParams
+    errors = simulate(motorsParams.AK80_64_V2_PARAMS)
+    print("RMS position error, raw reply: {:.5f} rad, estimator: {:.5f} rad".format(errors['raw_pos'], errors['est_pos']))
+    print("RMS velocity error, raw reply: {:.5f} rad/s, estimator: {:.5f} rad/s".format(errors['raw_vel'], errors['est_vel']))
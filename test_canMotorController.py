@@ -0,0 +1,75 @@
+import random
+import time
+import pytest
+from bitstring import BitArray
+import canMotorController as mot_con
+import stateEstimator
+
+
+@pytest.fixture
+def controller(fake_bus):
+    return mot_con.CanMotorController('can0', 0x01, 'AK80_9_V2'), fake_bus
+
+
+def bitarray_frame(p_des, v_des, kp, kd, tau_ff):
+    # Reference encoding of the original BitArray implementation of _send_raw_command.
+    return (BitArray(uint=p_des, length=16) + BitArray(uint=v_des, length=12)
+            + BitArray(uint=kp, length=12) + BitArray(uint=kd, length=12)
+            + BitArray(uint=tau_ff, length=12)).tobytes()
+
+
+def test_packing_matches_bitarray(controller):
+    motor, bus = controller
+    rng = random.Random(0)
+    raw = (0, 0, 0, 0, 0)
+    for i in range(2000):
+        if i % 3:
+            # Position-only change, exercises the cached tail bytes.
+            raw = (rng.randint(0, 2 ** 16 - 1),) + raw[1:]
+        else:
+            raw = (rng.randint(0, 2 ** 16 - 1),) + tuple(rng.randint(0, 2 ** 12 - 1) for _ in range(4))
+        motor._send_raw_command(*raw)
+        assert bus.sent[-1] == bitarray_frame(*raw)
+
+
+def test_repeated_command_resends_same_frame(controller):
+    motor, bus = controller
+    motor._send_raw_command(1234, 2047, 100, 50, 2047)
+    motor._send_raw_command(1234, 2047, 100, 50, 2047)
+    assert bus.sent[-1] == bus.sent[-2] == bitarray_frame(1234, 2047, 100, 50, 2047)
+
+
+@pytest.mark.parametrize('raw', [(2 ** 16, 0, 0, 0, 0), (-1, 0, 0, 0, 0), (0, 2 ** 12, 0, 0, 0),
+                                 (0, 0, 2 ** 12, 0, 0), (0, 0, 0, -1, 0), (0, 0, 0, 0, 2 ** 12)])
+def test_out_of_range_raw_values_raise(controller, raw):
+    motor, bus = controller
+    with pytest.raises(ValueError):
+        motor._send_raw_command(*raw)
+    assert bus.sent == []
+
+
+def test_estimator_stamped_with_bus_receive_time(controller):
+    motor, bus = controller
+    estimator = stateEstimator.StateEstimator.attach([motor])
+    bus.reply_age = 0.02
+    before = time.perf_counter()
+    motor.send_rad_command(0.0, 0.0, 0.0, 0.0, 0.0)
+    assert estimator.stamp[0] == pytest.approx(before - 0.02, abs=0.005)
+
+    # No driver timestamp: fall back to the time recv() returned.
+    bus.reply_age = None
+    before = time.perf_counter()
+    motor.send_rad_command(0.0, 0.0, 0.0, 0.0, 0.0)
+    assert before <= estimator.stamp[0] <= time.perf_counter()
+
+
+def test_hold_tick_updates_estimator(controller):
+    motor, bus = controller
+    estimator = stateEstimator.StateEstimator.attach([motor])
+    motor.send_rad_command(0.1, 0.0, 20.0, 1.0, 0.0)
+    stamp = estimator.stamp[0]
+    motor.set_hold_mode(True, keepalive_rate=1e6)
+    assert motor.hold_tick() is not None
+    assert estimator.stamp[0] > stamp
+    # Torque recomputed from the held command and the fake reply at position ~0.
+    assert estimator.torque[0] == pytest.approx(20.0 * 0.1, abs=0.1)
@@ -0,0 +1,79 @@
+import random
+import can
+import numpy as np
+import pytest
+import canMotorController as mot_con
+import canTrace
+import motorsParams
+
+motor_types = {0x01: 'AK80_9_V2', 0x02: 'AK80_64_V2'}
+motors = {motor_id: getattr(motorsParams, motor_type + '_PARAMS') for motor_id, motor_type in motor_types.items()}
+batch_size = 16
+
+
+def write_log(filename, num_frames=203):
+    """
+    Mix of 8-byte commands, 6-byte replies of motors 1 and 2 and replies of an unknown motor 3.
+    Returns the number of replies of known motors.
+    """
+    rng = random.Random(0)
+    writer = can.Logger(str(filename))
+    replies = 0
+    t = 1700000000.0
+    for i in range(num_frames):
+        t += 0.0005
+        motor_id = (1, 2, 3)[i % 3]
+        if i % 4 == 0:
+            data = bytes(rng.randrange(256) for _ in range(8))
+            msg = can.Message(timestamp=t, arbitration_id=motor_id, data=data, is_extended_id=False,
+                              is_rx=False)
+        else:
+            data = bytes([motor_id] + [rng.randrange(256) for _ in range(5)])
+            msg = can.Message(timestamp=t, arbitration_id=0, data=data, is_extended_id=False)
+            replies += motor_id in motors
+        writer.on_message_received(msg)
+    writer.stop()
+    return replies
+
+
+@pytest.fixture(params=['trace.asc', 'trace.blf', 'trace.log'])
+def trace(request, tmp_path):
+    filename = tmp_path / request.param
+    replies = write_log(filename)
+    assert replies % batch_size != 0
+    return str(filename), replies
+
+
+def collect(filename):
+    series = {mid: [[], [], [], []] for mid in motors}
+    for batch in canTrace.replay(filename, motors, batch_size=batch_size):
+        for mid, columns in batch.items():
+            for column, values in zip(series[mid], columns):
+                column.extend(values.tolist())
+    return {mid: np.array(columns) for mid, columns in series.items()}
+
+
+def test_replay_matches_scalar(trace):
+    filename, replies = trace
+    series = collect(filename)
+    assert sum(columns.shape[1] for columns in series.values()) == replies
+    scalar = list(canTrace.replay_scalar(filename, motors))
+    assert len(scalar) == replies
+    for mid in motors:
+        expected = np.array([row[:1] + row[2:] for row in scalar if row[1] == mid]).T
+        assert np.allclose(series[mid], expected, rtol=0, atol=1e-9)
+
+
+def test_replay_matches_controller_decode(trace, fake_bus):
+    filename, replies = trace
+    series = collect(filename)
+    controllers = {mid: mot_con.CanMotorController('can0', mid, motor_type)
+                   for mid, motor_type in motor_types.items()}
+    decoded = {mid: [] for mid in motors}
+    for msg in can.LogReader(filename):
+        if msg.dlc == canTrace.reply_dlc and msg.data[0] in controllers:
+            controller = controllers[msg.data[0]]
+            raw = controller.decode_motor_status(bytes(msg.data))
+            decoded[msg.data[0]].append(controller.convert_raw_to_physical_rad(*raw))
+    for mid in motors:
+        assert np.allclose(series[mid][1:], np.array(decoded[mid]).T, rtol=0, atol=1e-9)
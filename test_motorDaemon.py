@@ -0,0 +1,135 @@
+import socket
+import uuid
+from multiprocessing import resource_tracker
+import pytest
+import motorDaemon
+import motorsParams
+import utils
+
+params = motorsParams.AK80_64_V2_PARAMS
+enable_position = 6.25
+
+
+def reply_payload(position):
+    raw = utils.float_to_uint(position, params['P_MIN'], params['P_MAX'], 16)
+    return bytes([0x01, raw >> 8, raw & 0xFF, 0x80, 0x08, 0x00])
+
+
+def sent_position(frame):
+    raw = (frame[0] << 8) | frame[1]
+    return utils.uint_to_float(raw, params['P_MIN'], params['P_MAX'], 16) * params['AXIS_DIRECTION']
+
+
+@pytest.fixture
+def daemon(fake_bus, tmp_path, monkeypatch):
+    fake_bus.reply = reply_payload(enable_position)
+    daemon = motorDaemon.MotorDaemon([('can0', 0x01, 'AK80_64_V2'), ('can0', 0x02, 'AK80_64_V2')],
+                                     rate=500.0, name='ak_test_' + uuid.uuid4().hex[:8],
+                                     control_socket=str(tmp_path / 'control.sock'))
+    # Client and daemon share this process here, the client must not drop the daemon's
+    # resource tracker registration (Python < 3.13).
+    with monkeypatch.context() as patch:
+        patch.setattr(resource_tracker, 'unregister', lambda name, rtype: None)
+        client = motorDaemon.MotorClient(daemon._shm.name)
+    yield daemon, client, fake_bus
+    client.close()
+    daemon.close()
+
+
+def test_no_frames_before_enable_or_fresh_setpoint(daemon):
+    daemon, client, bus = daemon
+    client.write_command(0, 1.0, 0.0, 50.0, 1.0, 0.0)
+    daemon.step()
+    assert bus.sent == []
+
+    daemon.enable(0)
+    bus.sent.clear()
+    # The setpoint written before enable is stale and must not be sent.
+    daemon.step()
+    assert bus.sent == []
+
+    client.write_command(0, 6.2, 0.0, 50.0, 1.0, 0.0)
+    daemon.step()
+    assert len(bus.sent) == 1
+
+
+def test_first_command_slew_limited_from_enable_reply(daemon):
+    daemon, client, bus = daemon
+    daemon.enable(0)
+    bus.sent.clear()
+    client.write_command(0, 0.0, 0.0, 50.0, 1.0, 0.0)
+    daemon.step()
+    measured = sent_position(reply_payload(enable_position)[1:3])
+    expected = measured - params['V_MAX'] * daemon.period
+    resolution = (params['P_MAX'] - params['P_MIN']) / motorsParams.maxRawPosition
+    assert abs(sent_position(bus.sent[0]) - expected) <= 2 * resolution
+    assert daemon.limiter.clip_report()[0]['p_slew'] == 1
+
+
+def test_client_write_read_round_trip(daemon):
+    daemon, client, bus = daemon
+    client.write_command(1, 0.5, -0.25, 10.0, 0.5, 1.5)
+    seq, values = daemon._read_command(1)
+    assert seq == 2
+    assert values == [0.5, -0.25, 10.0, 0.5, 1.5]
+
+    daemon.enable(1)
+    state = client.read_state(1)
+    assert state[0] == pytest.approx(enable_position, abs=1e-3)
+    assert client.read_state(0)[0] != client.read_state(0)[0]  # never published, NaN
+
+
+def test_dead_writer_does_not_stall_step(daemon):
+    daemon, client, bus = daemon
+    daemon.enable(0)
+    client.write_command(0, 6.2, 0.0, 50.0, 1.0, 0.0)
+    daemon.step()
+    # Writer killed between the two increments: the counter stays odd.
+    client._cmd_seq[0] += 1
+    bus.sent.clear()
+    daemon.step()
+    assert daemon.seq_read_failures[0] == 1
+    assert len(bus.sent) == 1  # previous command kept
+    # A new writer recovers the slot.
+    client.write_command(0, 6.1, 0.0, 50.0, 1.0, 0.0)
+    assert daemon._read_command(0)[1][0] == 6.1
+
+
+def control_client(daemon):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(daemon._control_path)
+    daemon._poll_control()  # accept
+    return sock
+
+
+def test_bad_control_client_dropped_while_step_runs(daemon):
+    daemon, client, bus = daemon
+    good = control_client(daemon)
+    bad = control_client(daemon)
+    assert len(daemon._connections) == 2
+
+    # Sends a command and goes away without reading the reply.
+    bad.sendall(b'status\n')
+    bad.close()
+    daemon._poll_control()
+    daemon._poll_control()
+    assert len(daemon._connections) == 1
+
+    daemon.enable(0)
+    client.write_command(0, 6.2, 0.0, 50.0, 1.0, 0.0)
+    bus.sent.clear()
+    daemon.step()
+    assert len(bus.sent) == 1
+
+    good.sendall(b'status\n')
+    daemon._poll_control()
+    assert good.recv(100) == b'1 0\n'
+    good.close()
+
+
+@pytest.mark.parametrize('line', ['enable -1', 'zero 2', 'disable x', 'enable'])
+def test_control_rejects_bad_motor_index(daemon, line):
+    daemon, client, bus = daemon
+    assert daemon._handle_control_line(line).startswith('error')
+    assert daemon.enabled == [False, False]
+    assert bus.sent == []
@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+import canMotorController as mot_con
+import motorsParams
+import safetyLimits
+
+params = motorsParams.AK80_9_V2_PARAMS
+params_64 = motorsParams.AK80_64_V2_PARAMS
+
+
+def limiter(*motor_params, **kwargs):
+    return safetyLimits.SafetyLimiter(list(motor_params) or [params], **kwargs)
+
+
+def test_clamps_all_five_fields():
+    high = (100.0, 100.0, 1000.0, 10.0, 1000.0)
+    low = (-100.0, -100.0, -1.0, -1.0, -1000.0)
+    upper = [params[key] for key in ('P_MAX', 'V_MAX', 'KP_MAX', 'KD_MAX', 'T_MAX')]
+    lower = [params[key] for key in ('P_MIN', 'V_MIN', 'KP_MIN', 'KD_MIN', 'T_MIN')]
+
+    vector = limiter()
+    assert vector.apply(*high, now=0.0)[:, 0].tolist() == upper
+    vector.reset()
+    assert vector.apply(*low, now=1.0)[:, 0].tolist() == lower
+
+    scalar = limiter()
+    assert list(scalar.apply_one(0, *high, now=0.0)) == upper
+    scalar.reset()
+    assert list(scalar.apply_one(0, *low, now=1.0)) == lower
+
+    for lim in (vector, scalar):
+        assert lim.clip_counts[:5, 0].tolist() == [2, 2, 2, 2, 2]
+
+
+def test_position_slew_and_max_dt_cap():
+    lim = limiter(max_dt=0.1)
+    lim.apply(0.0, 0, 1, 0, 0, now=0.0)
+    # 1 ms later only V_MAX * 1 ms of travel is allowed.
+    p = lim.apply(3.0, 0, 1, 0, 0, now=0.001)[0, 0]
+    assert p == pytest.approx(params['V_MAX'] * 0.001)
+    # After a long pause the allowed step is capped at V_MAX * max_dt.
+    p_next = lim.apply(-3.0, 0, 1, 0, 0, now=100.0)[0, 0]
+    assert p_next == pytest.approx(p - params['V_MAX'] * 0.1)
+    assert lim.clip_counts[safetyLimits.CLIP_P_SLEW, 0] == 2
+
+
+def test_torque_slew_from_profile():
+    lim = limiter(dict(params, T_SLEW_MAX=100.0))
+    lim.apply_one(0, 0, 0, 0, 0, 0.0, now=0.0)
+    tau = lim.apply_one(0, 0, 0, 0, 0, 10.0, now=0.01)[4]
+    assert tau == pytest.approx(1.0)
+    assert lim.clip_counts[safetyLimits.CLIP_TAU_SLEW, 0] == 1
+
+
+def test_seed_starts_slew_from_measured_position():
+    lim = limiter()
+    lim.seed(0, 2.5, now=0.0)
+    p = lim.apply(0.0, 0, 50, 1, 0, now=0.002)[0, 0]
+    assert p == pytest.approx(2.5 - params['V_MAX'] * 0.002)
+    # Without a seed (after reset) the first command is not slew limited.
+    lim.reset(0)
+    assert lim.apply(0.0, 0, 50, 1, 0, now=0.003)[0, 0] == 0.0
+
+
+@pytest.mark.parametrize('bad', [np.nan, np.inf, -np.inf])
+def test_non_finite_holds_previous_command(bad):
+    for scalar in (False, True):
+        lim = limiter()
+        apply = (lambda *cmd, now: lim.apply_one(0, *cmd, now=now)) if scalar else \
+            (lambda *cmd, now: tuple(lim.apply(*cmd, now=now)[:, 0].tolist()))
+        # No previous command: zero gains and torque.
+        assert apply(bad, 0.0, 50.0, 1.0, 2.0, now=0.0) == (0.0, 0.0, 0.0, 0.0, 0.0)
+        assert apply(0.5, 0.0, 50.0, 1.0, 2.0, now=0.1) == (0.5, 0.0, 50.0, 1.0, 2.0)
+        assert apply(0.6, 0.0, bad, 1.0, 2.0, now=0.2) == (0.5, 0.0, 50.0, 1.0, 2.0)
+        # The slew state is not poisoned.
+        assert apply(0.6, 0.0, 50.0, 1.0, 2.0, now=0.3) == (0.6, 0.0, 50.0, 1.0, 2.0)
+        assert lim.clip_counts[safetyLimits.CLIP_NONFINITE, 0] == 2
+
+
+def test_apply_and_apply_one_agree_on_random_stream():
+    vector = limiter(params, params_64)
+    scalar = limiter(params, params_64)
+    rng = np.random.default_rng(0)
+    t = 0.0
+    for k in range(3000):
+        t += rng.uniform(0.0005, 0.3)
+        cmd = rng.uniform(-20, 20, (5, 2))
+        if k % 97 == 0:
+            cmd[rng.integers(5), rng.integers(2)] = np.nan
+        a = vector.apply(*cmd, now=t)
+        b = np.array([scalar.apply_one(i, *cmd[:, i], now=t) for i in range(2)]).T
+        assert np.array_equal(a, b)
+    assert np.array_equal(vector.clip_counts, scalar.clip_counts)
+
+
+def test_change_motor_constants_updates_shared_limiter(fake_bus):
+    motors = [mot_con.CanMotorController('can0', motor_id, 'AK80_9_V2') for motor_id in (1, 2)]
+    shared = safetyLimits.SafetyLimiter.attach(motors)
+    motors[1].change_motor_constants(-1.0, 1.0, -5.0, 5.0, 0.0, 100.0, 0.0, 2.0, -3.0, 3.0)
+
+    assert motors[1].limiter is shared and motors[1].limiter_index == 1
+    cmd = shared.apply(100.0, 100.0, 1000.0, 10.0, 100.0, now=0.0)
+    assert cmd[:, 1].tolist() == [1.0, 5.0, 100.0, 2.0, 3.0]
+    # The other controller of the same motor type keeps its own constants.
+    assert cmd[:, 0].tolist() == [params['P_MAX'], params['V_MAX'], params['KP_MAX'],
+                                  params['KD_MAX'], params['T_MAX']]
+    assert motors[0].motorParams['P_MAX'] == params['P_MAX']
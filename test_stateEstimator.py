@@ -0,0 +1,26 @@
+import numpy as np
+import motorsParams
+import stateEstimator
+
+
+def test_estimator_beats_raw_reply_in_simulation():
+    errors = stateEstimator.simulate(motorsParams.AK80_64_V2_PARAMS, duration=0.5)
+    # Typically ~30x better in position and ~2.5x better in velocity.
+    assert errors['est_pos'] < 0.2 * errors['raw_pos']
+    assert errors['est_vel'] < 0.7 * errors['raw_vel']
+
+
+def test_update_one_matches_update():
+    vector = stateEstimator.StateEstimator(2, inertia=0.02, latency=0.0005)
+    scalar = stateEstimator.StateEstimator(2, inertia=0.02, latency=0.0005)
+    rng = np.random.default_rng(0)
+    t = 0.0
+    for _ in range(200):
+        t += rng.uniform(0.001, 0.02)
+        p, v, tau = rng.normal(size=(3, 2))
+        vector.update(slice(None), p, v, t)
+        for i in range(2):
+            scalar.update_one(i, p[i], v[i], t)
+        vector.set_torque(slice(None), tau)
+        scalar.set_torque(slice(None), tau)
+    assert np.allclose(vector.predict(t + 0.003), scalar.predict(t + 0.003))